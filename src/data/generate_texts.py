@@ -8,6 +8,8 @@ import mlflow
 import openai
 import yaml
 
+from src.utils.profiling import PROFILE_MODES, profile_run
+
 
 def load_credential(credential_path: str) -> Dict:
     """credential ファイルを読み込む"""
@@ -108,6 +110,7 @@ def generate_texts(openai_api_key, kwargs):
 @click.argument("output_generated_filepath", type=click.Path())
 @click.argument("output_prompt_filepath", type=click.Path())
 @click.option("--param_n", type=int, default=10)
+@click.option("--profile", type=click.Choice(PROFILE_MODES), default=None)
 @click.option("--mlflow_run_name", type=str, default="develop")
 def main(**kwargs):
     """メイン処理"""
@@ -122,19 +125,22 @@ def main(**kwargs):
     mlflow.start_run(run_name=kwargs["mlflow_run_name"])
     mlflow.log_params({f"args.{k}": v for k, v in kwargs.items()})
 
-    # load credentials
-    credential = load_credential("config/credential.yaml")
-
-    # generate texts
-    prompt, response = generate_texts(credential["openai"]["api_key"], kwargs)
-
-    # log response dump
-    openai_response_filepath = kwargs["output_generated_filepath"]
-    json.dump(response, open(openai_response_filepath, "w"), indent=2)
-    mlflow.log_artifact(openai_response_filepath)
-    prompt_filepath = kwargs["output_prompt_filepath"]
-    print(prompt, file=open(prompt_filepath, "w"))
-    mlflow.log_artifact(prompt_filepath)
+    with profile_run(kwargs["profile"], "generate_texts"):
+        # load credentials
+        credential = load_credential("config/credential.yaml")
+
+        # generate texts
+        prompt, response = generate_texts(
+            credential["openai"]["api_key"], kwargs
+        )
+
+        # log response dump
+        openai_response_filepath = kwargs["output_generated_filepath"]
+        json.dump(response, open(openai_response_filepath, "w"), indent=2)
+        mlflow.log_artifact(openai_response_filepath)
+        prompt_filepath = kwargs["output_prompt_filepath"]
+        print(prompt, file=open(prompt_filepath, "w"))
+        mlflow.log_artifact(prompt_filepath)
 
     # cleanup
     mlflow.end_run()
@@ -1,27 +1,386 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import logging
+import os
+import shutil
+import time
+from collections import Counter
 from pathlib import Path
+from typing import Dict, Iterator, List, Set
 
 import click
+import mlflow
+import pandas as pd
 from dotenv import find_dotenv, load_dotenv
 
+from src.features.parse_texts import (
+    COLUMN_NAMES,
+    hash_row,
+    parse_response_chunks,
+)
+
+INPUT_SUFFIXES = [".json", ".jsonl", ".csv"]
+MANIFEST_FILENAME = "_manifest.json"
+SOURCES_FILENAME = "_sources.json"
+
+
+def expand_inputs(input_paths) -> List[str]:
+    """入力のディレクトリを展開し、パス順に並べる"""
+    filepaths = []
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            # _ で始まるファイルは manifest などの管理用なので読まない
+            filepaths += [
+                str(path)
+                for path in Path(input_path).rglob("*")
+                if path.suffix in INPUT_SUFFIXES
+                and not path.name.startswith("_")
+            ]
+        else:
+            filepaths.append(str(input_path))
+    return sorted(set(filepaths))
+
+
+def hash_file(filepath: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as fo:
+        for block in iter(lambda: fo.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def archive_inputs(filepaths, archive_dirpath) -> Dict[str, str]:
+    """
+    入力を内容のハッシュ名で保管庫にコピーする
+
+    保管庫の全ファイルについて、保管庫のパスから元の入力のパスへの
+    対応を返す。対応は保管庫の _sources.json に残し、過去の実行で
+    コピーしたファイルも元のパスを引けるようにする。
+    """
+    os.makedirs(archive_dirpath, exist_ok=True)
+    sources_filepath = os.path.join(archive_dirpath, SOURCES_FILENAME)
+    sources: Dict[str, str] = {}
+    if os.path.exists(sources_filepath):
+        with open(sources_filepath) as fo:
+            sources = json.load(fo)
+
+    for filepath in filepaths:
+        suffix = Path(filepath).suffix
+        archive_filename = f"{hash_file(filepath)[:16]}{suffix}"
+        archive_filepath = os.path.join(archive_dirpath, archive_filename)
+        if not os.path.exists(archive_filepath):
+            shutil.copyfile(filepath, f"{archive_filepath}.tmp")
+            os.replace(f"{archive_filepath}.tmp", archive_filepath)
+        # 同じ内容の入力が複数あれば最初に見つけたパスを残す
+        sources.setdefault(archive_filename, str(filepath))
+
+    tmp_filepath = f"{sources_filepath}.tmp"
+    with open(tmp_filepath, "w") as fo:
+        json.dump(sources, fo, indent=2, ensure_ascii=False)
+    os.replace(tmp_filepath, sources_filepath)
+
+    return {
+        filepath: sources.get(Path(filepath).name, filepath)
+        for filepath in expand_inputs([archive_dirpath])
+    }
+
+
+def check_response(response):
+    # ChatCompletion のレスポンス以外の json は parse_response に渡さない
+    if not isinstance(response, dict) or not isinstance(
+        response.get("choices"), list
+    ):
+        raise ValueError("not a ChatCompletion response")
+    return response
+
+
+def read_chunks(filepath: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    """生成結果 (json, jsonl) やパース済み CSV をチャンク単位で読み込む"""
+    suffix = Path(filepath).suffix
+    if suffix == ".csv":
+        header = pd.read_csv(filepath, nrows=0).columns
+        if not set(COLUMN_NAMES) <= set(header):
+            raise ValueError(f"unexpected columns: {list(header)}")
+        usecols = COLUMN_NAMES + (["index"] if "index" in header else [])
+        yield from pd.read_csv(
+            filepath, usecols=usecols, dtype=str, chunksize=chunksize
+        )
+        return
+
+    if suffix == ".json":
+        with open(filepath) as fo:
+            responses: Iterator[Dict] = iter([json.load(fo)])
+    else:
+        # replay_requests の出力シャード
+        responses = (
+            json.loads(line)["response"]
+            for line in open(filepath)
+            if len(line.strip()) > 0
+        )
+    for response in responses:
+        yield from parse_response_chunks(check_response(response), chunksize)
+
+
+class DatasetBuilder:
+    """
+    複数の生成結果を 1 つのデータセットにまとめる
+
+    入力ごとに内容のハッシュから run_id を決め、run_id=<id>/ 以下に
+    Parquet を書き出す。パーティションは追記のみで、入力が変わったり
+    引数から消えたりしても既存のパーティションは残す。行は内容の
+    ハッシュで完全一致の重複を除き、先に取り込んだ run の行を残す。
+    manifest に入力のサイズ、更新時刻、ハッシュを記録し、変わって
+    いない入力は再実行時に読み飛ばす。読めなかった入力もハッシュで
+    記録し、--force で作り直すまでは再び読まない。
+    """
+
+    def __init__(self, output_dirpath, chunksize=100000):
+        self.output_dirpath = output_dirpath
+        self.chunksize = chunksize
+        self.manifest_filepath = os.path.join(
+            output_dirpath, MANIFEST_FILENAME
+        )
+        self.manifest: Dict[str, Dict] = {
+            "runs": {},
+            "inputs": {},
+            "failed": {},
+        }
+        self.seen_hashes: Set[str] = set()
+        self.stats: Counter = Counter()
+
+    def _partition_dirpath(self, run_id):
+        return os.path.join(self.output_dirpath, f"run_id={run_id}")
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_filepath):
+            with open(self.manifest_filepath) as fo:
+                self.manifest = json.load(fo)
+            self.manifest.setdefault("failed", {})
+
+    def _save_manifest(self):
+        tmp_filepath = f"{self.manifest_filepath}.tmp"
+        with open(tmp_filepath, "w") as fo:
+            json.dump(self.manifest, fo, indent=2, ensure_ascii=False)
+        os.replace(tmp_filepath, self.manifest_filepath)
+
+    def _reset(self):
+        """このクラスが書き出したパーティションと manifest だけを消す"""
+        for path in Path(self.output_dirpath).glob("run_id=*"):
+            shutil.rmtree(path)
+        if os.path.exists(self.manifest_filepath):
+            os.remove(self.manifest_filepath)
+        self.manifest = {"runs": {}, "inputs": {}, "failed": {}}
+
+    def _remove_orphans(self):
+        # manifest に記録される前に中断した書きかけのパーティションを消す
+        for path in Path(self.output_dirpath).glob("run_id=*"):
+            if path.name.split("=", 1)[1] not in self.manifest["runs"]:
+                shutil.rmtree(path)
+
+    def _load_seen_hashes(self):
+        self.seen_hashes = set()
+        for path in Path(self.output_dirpath).glob("run_id=*/*.parquet"):
+            row_hashes = pd.read_parquet(path, columns=["row_hash"])
+            if pd.api.types.is_integer_dtype(row_hashes["row_hash"]):
+                # 以前の 64 bit ハッシュで書かれたパーティションとは混ぜない
+                raise ValueError(
+                    f"{path} uses an old row_hash, rebuild with --force"
+                )
+            self.seen_hashes.update(row_hashes["row_hash"].tolist())
+
+    def _is_unchanged(self, filepath, stat):
+        entry = self.manifest["inputs"].get(filepath)
+        if entry is None:
+            return False
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+        # 更新時刻だけが変わった場合は内容のハッシュで判定する
+        if entry["sha1"] == hash_file(filepath):
+            entry["mtime"] = stat.st_mtime
+            return True
+        return False
+
+    def _deduplicate(self, chunk_df):
+        result_df = chunk_df.assign(
+            **{
+                name: chunk_df[name].fillna("").astype(str)
+                for name in COLUMN_NAMES
+            }
+        )
+        # index の無い CSV でもスキーマが揃うよう nullable な Int64 にする
+        if "index" in result_df:
+            index = pd.to_numeric(result_df["index"]).astype("Int64")
+        else:
+            index = pd.array([pd.NA] * len(result_df), dtype="Int64")
+        result_df = result_df.assign(index=index)
+        # search_index と同じハッシュにして、行を両者で突き合わせられる
+        # ようにする
+        row_hashes = [
+            hash_row(cells)
+            for cells in result_df[COLUMN_NAMES].itertuples(
+                index=False, name=None
+            )
+        ]
+        keep = []
+        for row_hash in row_hashes:
+            keep.append(row_hash not in self.seen_hashes)
+            self.seen_hashes.add(row_hash)
+        return result_df.assign(row_hash=row_hashes)[keep]
+
+    def _add_input(self, filepath, run_id, source):
+        # init log
+        logger = logging.getLogger(__name__)
+
+        partition_dirpath = self._partition_dirpath(run_id)
+        os.makedirs(partition_dirpath)
+        n_read, n_written = 0, 0
+        for part_index, chunk_df in enumerate(
+            read_chunks(filepath, self.chunksize)
+        ):
+            n_read += len(chunk_df)
+            result_df = self._deduplicate(chunk_df).assign(source=source)
+            n_written += len(result_df)
+            if len(result_df) > 0:
+                part_filepath = os.path.join(
+                    partition_dirpath, f"part-{part_index:05d}.parquet"
+                )
+                result_df.reset_index(drop=True).to_parquet(
+                    part_filepath, index=False
+                )
+        logger.info(f"{filepath}: run_id={run_id}, {n_written}/{n_read}")
+        self.stats["n_rows_read"] += n_read
+        self.stats["n_rows_written"] += n_written
+        return n_read, n_written
+
+    def build(self, input_paths, force=False, sources=None):
+        """
+        入力を差分だけ取り込んでデータセットを更新する
+
+        sources には保管庫から読む場合の、入力のパスから元のパスへの
+        対応を渡す。行の source 列と manifest には元のパスを記録する。
+        """
+
+        # init log
+        logger = logging.getLogger(__name__)
+
+        filepaths = expand_inputs(input_paths)
+        os.makedirs(self.output_dirpath, exist_ok=True)
+        self._load_manifest()
+        if force:
+            logger.info("rebuild dataset")
+            self._reset()
+        self._remove_orphans()
+        self._load_seen_hashes()
+
+        for filepath in filepaths:
+            self.stats["n_inputs"] += 1
+            stat = os.stat(filepath)
+            if self._is_unchanged(filepath, stat):
+                logger.info(f"skip unchanged: {filepath}")
+                self.stats["n_skipped"] += 1
+                continue
+
+            source = (sources or {}).get(filepath, filepath)
+            sha1 = hash_file(filepath)
+            run_id = sha1[:16]
+            if sha1 in self.manifest["failed"]:
+                # 以前読めなかった内容は --force まで読み直さない
+                logger.info(f"skip failed before: {filepath}")
+                self.stats["n_skipped"] += 1
+                continue
+            if run_id in self.manifest["runs"]:
+                # 取り込み済みの内容と同じ入力は読まない
+                self.stats["n_skipped"] += 1
+            else:
+                try:
+                    n_read, n_written = self._add_input(
+                        filepath, run_id, source
+                    )
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"skip {filepath}: {e}")
+                    self.stats["n_failed"] += 1
+                    # 途中まで書いた行を捨て、重複判定をやり直す
+                    shutil.rmtree(self._partition_dirpath(run_id))
+                    self._load_seen_hashes()
+                    self.manifest["failed"][sha1] = {
+                        "source": source,
+                        "error": str(e),
+                    }
+                    self._save_manifest()
+                    continue
+                self.manifest["runs"][run_id] = {
+                    "source": source,
+                    "sha1": sha1,
+                    "n_rows_read": n_read,
+                    "n_rows_written": n_written,
+                }
+
+            self.manifest["inputs"][filepath] = {
+                "source": source,
+                "run_id": run_id,
+                "sha1": sha1,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+            self._save_manifest()
+
+        self._save_manifest()
+        return self.stats
+
 
 @click.command()
-@click.argument("input_filepath", type=click.Path(exists=True))
-@click.argument("output_filepath", type=click.Path())
-def main(input_filepath, output_filepath):
+@click.argument("output_dirpath", type=click.Path())
+@click.argument("input_paths", type=click.Path(exists=True), nargs=-1)
+@click.option("--archive_dirpath", type=click.Path(), default=None)
+@click.option("--chunksize", type=int, default=100000)
+@click.option("--force", is_flag=True, default=False)
+@click.option("--mlflow_run_name", type=str, default="develop")
+def main(**kwargs):
     """Runs data processing scripts to turn raw data from (../raw) into
     cleaned data ready to be analyzed (saved in ../processed).
     """
     logger = logging.getLogger(__name__)
     logger.info("making final data set from raw data")
+    logger.info({f"args.{k}": v for k, v in kwargs.items()})
+    mlflow.set_experiment("make_dataset")
+    mlflow.start_run(run_name=kwargs["mlflow_run_name"])
+    mlflow.log_params({f"args.{k}": v for k, v in kwargs.items()})
+
+    start_time = time.time()
+    builder = DatasetBuilder(
+        kwargs["output_dirpath"], chunksize=kwargs["chunksize"]
+    )
+    input_paths = kwargs["input_paths"]
+    sources = None
+    if kwargs["archive_dirpath"] is not None:
+        # 上書きされる入力も run ごとに残るよう保管庫から読む
+        sources = archive_inputs(
+            expand_inputs(input_paths), kwargs["archive_dirpath"]
+        )
+        input_paths = list(sources)
+    stats = builder.build(
+        input_paths, force=kwargs["force"], sources=sources
+    )
+    elapsed_time = time.time() - start_time
+
+    # logging
+    logger.info(f"elapsed_time: {elapsed_time}")
+    logger.info(dict(stats))
+    mlflow.log_metric("elapsed_time", elapsed_time)
+    mlflow.log_metrics(dict(stats))
+    mlflow.log_artifact(builder.manifest_filepath)
+
+    # cleanup
+    mlflow.end_run()
+    logger.info("complete process")
 
 
 if __name__ == "__main__":
     log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     logging.basicConfig(level=logging.INFO, format=log_fmt)
 
-    # not used in this stub but often useful for finding various files
+    # not used here but often useful for finding various files
     project_dir = Path(__file__).resolve().parents[2]
 
     # find .env automagically by walking up directories until it's found, then
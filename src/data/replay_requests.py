@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Dict, Iterator, List, Set
+
+import click
+import mlflow
+import openai
+
+from src.data.generate_texts import load_credential
+
+PROMPT_KEYS = ["messages", "prompt", "body"]
+
+
+def read_requests(input_filepath: str) -> Iterator[Dict]:
+    """JSONL ファイルからリクエストを 1 件ずつ読み込む"""
+
+    # init log
+    logger = logging.getLogger(__name__)
+
+    with open(input_filepath) as fo:
+        for line_number, line in enumerate(fo, start=1):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            # 壊れた行は全体を止めずに読み飛ばす
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"skip line {line_number}: {e}")
+                continue
+            if not isinstance(record, dict) or "request_id" not in record:
+                logger.warning(f"skip line {line_number}: no request_id")
+                continue
+            # プロンプトの無いリクエストは何度送っても失敗するので送らない
+            if not any(record.get(key) for key in PROMPT_KEYS):
+                logger.warning(f"skip line {line_number}: no prompt")
+                continue
+            yield record
+
+
+def build_messages(record: Dict) -> List[Dict]:
+    """リクエストから chat の messages を作成"""
+    if record.get("messages"):
+        return record["messages"]
+    prompt = record.get("prompt") or record["body"]
+    return [{"role": "user", "content": prompt}]
+
+
+def call_api(record: Dict, model: str, param_n: int) -> Dict:
+    """1 件のリクエストを API に送信"""
+    start_time = time.time()
+    response = openai.ChatCompletion.create(
+        model=record.get("model", model),
+        messages=build_messages(record),
+        n=record.get("n", param_n),
+    )
+    return {
+        "request_id": record["request_id"],
+        "elapsed_time": time.time() - start_time,
+        "response": response,
+    }
+
+
+class Journal:
+    """
+    処理済みの request_id を記録するジャーナル
+
+    レスポンスを書き出した後に追記するため、クラッシュ時は最大で
+    書き出し途中の 1 件が再送される (at-least-once)。
+    """
+
+    def __init__(self, journal_filepath):
+        self.journal_filepath = journal_filepath
+        self.processed_ids = self._load()
+        self.fo = open(journal_filepath, "a")
+
+    def _load(self) -> Set[str]:
+        if not os.path.exists(self.journal_filepath):
+            return set()
+        with open(self.journal_filepath) as fo:
+            return {line.strip() for line in fo if len(line.strip()) > 0}
+
+    def __contains__(self, request_id):
+        return request_id in self.processed_ids
+
+    def add(self, request_id):
+        self.fo.write(f"{request_id}\n")
+        self.fo.flush()
+        os.fsync(self.fo.fileno())
+        self.processed_ids.add(request_id)
+
+    def close(self):
+        self.fo.close()
+
+
+class ShardedWriter:
+    """
+    シャード分割した JSONL の書き出し
+
+    再開時に既存のシャードを上書きしないよう、番号は既存ファイルの続きから
+    振る。
+    """
+
+    def __init__(self, output_dirpath, shard_size=1000):
+        self.output_dirpath = output_dirpath
+        self.shard_size = shard_size
+        self.shard_index = len(
+            [
+                name
+                for name in os.listdir(output_dirpath)
+                if name.startswith("responses-") and name.endswith(".jsonl")
+            ]
+        )
+        self.n_lines = 0
+        self.fo = None
+
+    def _open_next_shard(self):
+        if self.fo is not None:
+            self.fo.close()
+        shard_filepath = os.path.join(
+            self.output_dirpath, f"responses-{self.shard_index:05d}.jsonl"
+        )
+        self.fo = open(shard_filepath, "w")
+        self.shard_index += 1
+        self.n_lines = 0
+
+    def write(self, result: Dict):
+        if self.fo is None or self.n_lines >= self.shard_size:
+            self._open_next_shard()
+        self.fo.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.fo.flush()
+        self.n_lines += 1
+
+    def close(self):
+        if self.fo is not None:
+            self.fo.close()
+
+
+def replay_requests(input_filepath, output_dirpath, kwargs) -> Counter:
+    """リクエストを並列に API へ送り、完了順に書き出す"""
+
+    # init log
+    logger = logging.getLogger(__name__)
+
+    os.makedirs(output_dirpath, exist_ok=True)
+    journal = Journal(os.path.join(output_dirpath, "processed_ids.txt"))
+    writer = ShardedWriter(output_dirpath, shard_size=kwargs["shard_size"])
+    stats: Counter = Counter()
+    max_workers = kwargs["max_workers"]
+
+    def drain(pending, return_when):
+        # 完了したものから書き出し、未完了のものを返す
+        done, pending = wait(pending, return_when=return_when)
+        for future in done:
+            request_id = pending_ids.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                # ジャーナルに載せないため、次回の実行で再送される
+                logger.warning(f"failed: {request_id}: {e}")
+                stats["n_failed"] += 1
+                continue
+            writer.write(result)
+            journal.add(request_id)
+            stats["n_processed"] += 1
+            stats.update(result["response"].get("usage", {}))
+            logger.info(
+                f"done: {request_id} ({result['elapsed_time']:0.2f} sec)"
+            )
+        return pending
+
+    pending_ids: Dict = {}
+    pending: Set = set()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for record in read_requests(input_filepath):
+                request_id = record["request_id"]
+                # 送信中の request_id も重複として扱い、二重に送らない
+                if request_id in journal or request_id in pending_ids.values():
+                    stats["n_skipped"] += 1
+                    continue
+
+                # 読み込みを先行させすぎないよう、投入数をワーカー数で抑える
+                if len(pending) >= max_workers:
+                    pending = drain(pending, FIRST_COMPLETED)
+                future = executor.submit(
+                    call_api, record, kwargs["model"], kwargs["param_n"]
+                )
+                pending_ids[future] = request_id
+                pending.add(future)
+    finally:
+        # 中断されても、送信済みのリクエストの結果は書き出してから閉じる
+        try:
+            drain(pending, ALL_COMPLETED)
+        finally:
+            writer.close()
+            journal.close()
+
+    return stats
+
+
+@click.command()
+@click.argument("input_filepath", type=click.Path(exists=True))
+@click.argument("output_dirpath", type=click.Path())
+@click.option("--model", type=str, default="gpt-3.5-turbo-0613")
+@click.option("--param_n", type=int, default=1)
+@click.option("--max_workers", type=int, default=8)
+@click.option("--shard_size", type=int, default=1000)
+@click.option("--mlflow_run_name", type=str, default="develop")
+def main(**kwargs):
+    """メイン処理"""
+
+    # init log
+    logger = logging.getLogger(__name__)
+
+    # logging
+    logger.info("start process")
+    logger.info({f"args.{k}": v for k, v in kwargs.items()})
+    mlflow.set_experiment("リクエストを一括で再生する")
+    mlflow.start_run(run_name=kwargs["mlflow_run_name"])
+    mlflow.log_params({f"args.{k}": v for k, v in kwargs.items()})
+
+    # load credentials
+    credential = load_credential("config/credential.yaml")
+    openai.api_key = credential["openai"]["api_key"]
+
+    # replay
+    start_time = time.time()
+    stats = replay_requests(
+        kwargs["input_filepath"], kwargs["output_dirpath"], kwargs
+    )
+    elapsed_time = time.time() - start_time
+
+    # logging
+    logger.info(f"elapsed_time: {elapsed_time}")
+    logger.info(dict(stats))
+    mlflow.log_metric("elapsed_time", elapsed_time)
+    mlflow.log_metrics(dict(stats))
+
+    # cleanup
+    mlflow.end_run()
+    logger.info("complete process")
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
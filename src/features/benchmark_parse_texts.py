@@ -0,0 +1,134 @@
+import json
+import logging
+import random
+import time
+import tracemalloc
+
+import click
+import mlflow
+import pandas as pd
+
+from src.features.parse_texts import COLUMN_NAMES, parse_response
+
+
+def parse_response_concat(response):
+    """choice ごとに DataFrame を作って concat する従来の実装 (比較用)"""
+    results = []
+    for index, choice in enumerate(response["choices"]):
+        arguments = choice["message"]["function_call"]["arguments"]
+        messages = json.loads(arguments)["text"]
+        lines = []
+        for line in messages.split("\n"):
+            line = line.strip()
+            if len(line) > 0:
+                cells = line.split(",")
+                if len(cells) == 3 and cells[1] != COLUMN_NAMES[1]:
+                    lines.append(cells)
+        result_df = pd.DataFrame(lines, columns=COLUMN_NAMES).assign(
+            index=index
+        )
+        results.append(result_df)
+
+    result_df = pd.concat(results).reset_index(drop=True)
+    return result_df
+
+
+def build_response(n_rows, rows_per_choice, n_reasons, n_categories, seed):
+    """function calling 形式の疑似レスポンスを作成"""
+    rng = random.Random(seed)
+    categories = [f"カテゴリ{i}" for i in range(n_categories)]
+    reasons = [
+        (f"ネガティブな転職理由{i}", f"ポジティブな言い換え{i}")
+        for i in range(n_reasons)
+    ]
+    choices = []
+    for start in range(0, n_rows, rows_per_choice):
+        lines = [",".join(COLUMN_NAMES)]
+        for _ in range(min(rows_per_choice, n_rows - start)):
+            negative, positive = rng.choice(reasons)
+            lines.append(f"{negative},{positive},{rng.choice(categories)}")
+        arguments = json.dumps({"text": "\n".join(lines)}, ensure_ascii=False)
+        choices.append(
+            {
+                "finish_reason": "function_call",
+                "message": {
+                    "function_call": {
+                        "name": "create_csv_file",
+                        "arguments": arguments,
+                    }
+                },
+            }
+        )
+    return {"choices": choices}
+
+
+def measure(parse_fn, response):
+    """処理時間、tracemalloc のピーク、結果のメモリ使用量を計測"""
+    tracemalloc.start()
+    start_time = time.time()
+    result_df = parse_fn(response)
+    elapsed_time = time.time() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    frame_bytes = result_df.memory_usage(deep=True).sum()
+    return {
+        "n_rows": len(result_df),
+        "elapsed_time": elapsed_time,
+        "peak_mb": peak / 1024**2,
+        "frame_mb": float(frame_bytes) / 1024**2,
+    }
+
+
+@click.command()
+@click.option("--n_rows", type=int, default=1000000)
+@click.option("--rows_per_choice", type=int, default=20)
+@click.option("--n_reasons", type=int, default=5000)
+@click.option("--n_categories", type=int, default=20)
+@click.option("--seed", type=int, default=1234)
+@click.option("--mlflow_run_name", type=str, default="develop")
+def main(**kwargs):
+    """メイン処理"""
+
+    # init log
+    logger = logging.getLogger(__name__)
+
+    # logging
+    logger.info("start process")
+    logger.info({f"args.{k}": v for k, v in kwargs.items()})
+    mlflow.set_experiment("parse_texts_benchmark")
+    mlflow.start_run(run_name=kwargs["mlflow_run_name"])
+    mlflow.log_params({f"args.{k}": v for k, v in kwargs.items()})
+
+    # 生成される理由はほとんど重複しないため、理由の種類を行数と同じに
+    # した場合を主に見る。n_reasons 種類が繰り返される場合も比較用に測る
+    for scenario, n_reasons in [
+        ("unique", kwargs["n_rows"]),
+        ("repeated", kwargs["n_reasons"]),
+    ]:
+        response = build_response(
+            kwargs["n_rows"],
+            kwargs["rows_per_choice"],
+            n_reasons,
+            kwargs["n_categories"],
+            kwargs["seed"],
+        )
+        for name, parse_fn in [
+            ("concat", parse_response_concat),
+            ("accumulator", parse_response),
+        ]:
+            result = measure(parse_fn, response)
+            logger.info(f"{scenario}.{name}: {result}")
+            mlflow.log_metrics(
+                {f"{scenario}.{name}.{k}": v for k, v in result.items()}
+            )
+        del response
+
+    # cleanup
+    mlflow.end_run()
+    logger.info("complete process")
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -1,17 +1,96 @@
+import hashlib
 import json
 import logging
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import click
 import mlflow
+import numpy as np
 import pandas as pd
 
+from src.utils.profiling import PROFILE_MODES, profile_run
 
-def parse_response(response):
+COLUMN_NAMES = ["ネガティブな転職理由", "ポジティブな言い換え", "カテゴリ"]
+
+
+def hash_row(cells) -> str:
+    """行 (COLUMN_NAMES の順のセル) の内容から重複判定用のハッシュを作る"""
+    key = "\x1f".join(cells)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class RowAccumulator:
+    """
+    パース結果の行を列ごとに貯めるアキュムレータ
+
+    種類の少ない列 (カテゴリ) だけを intern してコードを array に持ち、
+    文字列の列は list に貯めて最後に Arrow の文字列型にまとめる。
+    choice ごとに小さな DataFrame を作って concat するより省メモリで速い。
+    """
+
+    def __init__(
+        self, column_names=COLUMN_NAMES, categorical_names=COLUMN_NAMES[2:]
+    ):
+        self.column_names = list(column_names)
+        self.categorical_names = set(categorical_names)
+        self._reset()
+
+    def _reset(self):
+        # カテゴリ列は値からコードへの辞書、文字列の列は None
+        self.vocabularies: List[Optional[Dict[str, int]]] = [
+            {} if name in self.categorical_names else None
+            for name in self.column_names
+        ]
+        self.values: List = [
+            array("i") if vocabulary is not None else []
+            for vocabulary in self.vocabularies
+        ]
+        self.indexes = array("i")
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def append(self, cells, index):
+        for vocabulary, values, cell in zip(
+            self.vocabularies, self.values, cells
+        ):
+            if vocabulary is None:
+                values.append(cell)
+            else:
+                values.append(vocabulary.setdefault(cell, len(vocabulary)))
+        self.indexes.append(index)
+
+    def to_frame(self) -> pd.DataFrame:
+        """貯めた行を 1 つの DataFrame にする"""
+        columns = {}
+        for name, vocabulary, values in zip(
+            self.column_names, self.vocabularies, self.values
+        ):
+            if vocabulary is None:
+                columns[name] = pd.array(values, dtype="string[pyarrow]")
+            else:
+                columns[name] = pd.Categorical.from_codes(
+                    np.array(values, dtype=np.int32),
+                    categories=list(vocabulary),
+                )
+        columns["index"] = np.array(self.indexes, dtype=np.int32)
+        return pd.DataFrame(columns)
+
+    def pop_frame(self) -> pd.DataFrame:
+        """貯めた行を DataFrame にしてバッファを空にする"""
+        result_df = self.to_frame()
+        self._reset()
+        return result_df
+
+
+def iter_rows(response) -> Iterator[Tuple[List[str], int]]:
+    """レスポンスから (セルのリスト, choice の番号) を 1 行ずつ取り出す"""
     # init log
     logger = logging.getLogger(__name__)
-    logger.info(f"full response: {response}")
+    # 巨大なレスポンスでも書式化のコストを払わないよう遅延評価にする
+    logger.debug("full response: %s", response)
 
-    results = []
     for index, choice in enumerate(response["choices"]):
         if choice["finish_reason"] == "function_call":
             if choice["message"]["function_call"]["name"] == "create_csv_file":
@@ -24,27 +103,39 @@ def parse_response(response):
             messages = choice["message"]["content"]
 
         # parsing
-        column_names = ["ネガティブな転職理由", "ポジティブな言い換え", "カテゴリ"]
-        lines = []
         for line in messages.split("\n"):
             line = line.strip()
-            logger.info(f"line : \n{line }")
+            logger.debug("line : \n%s", line)
             if len(line) > 0:
                 cells = line.split(",")
-                if len(cells) == 3 and cells[1] != column_names[1]:
-                    lines.append(cells)
-        result_df = pd.DataFrame(lines, columns=column_names).assign(
-            index=index
-        )
-        results.append(result_df)
-
-    result_df = pd.concat(results).reset_index(drop=True)
+                if len(cells) == 3 and cells[1] != COLUMN_NAMES[1]:
+                    yield cells, index
+
+
+def parse_response(response):
+    accumulator = RowAccumulator()
+    for cells, index in iter_rows(response):
+        accumulator.append(cells, index)
+
+    result_df = accumulator.to_frame()
     return result_df
 
 
+def parse_response_chunks(response, chunksize) -> Iterator[pd.DataFrame]:
+    """レスポンスを chunksize 行ずつの DataFrame にして順に返す"""
+    accumulator = RowAccumulator()
+    for cells, index in iter_rows(response):
+        accumulator.append(cells, index)
+        if len(accumulator) >= chunksize:
+            yield accumulator.pop_frame()
+    if len(accumulator) > 0:
+        yield accumulator.pop_frame()
+
+
 @click.command()
 @click.argument("input_filepath", type=click.Path(exists=True))
 @click.argument("output_filepath", type=click.Path())
+@click.option("--profile", type=click.Choice(PROFILE_MODES), default=None)
 @click.option("--mlflow_run_name", type=str, default="develop")
 def main(**kwargs):
     """メイン処理"""
@@ -59,9 +150,10 @@ def main(**kwargs):
     mlflow.start_run(run_name=kwargs["mlflow_run_name"])
     mlflow.log_params({f"args.{k}": v for k, v in kwargs.items()})
 
-    response = json.load(open(kwargs["input_filepath"], "r"))
-    result_df = parse_response(response)
-    result_df.to_csv(kwargs["output_filepath"])
+    with profile_run(kwargs["profile"], "parse_texts"):
+        response = json.load(open(kwargs["input_filepath"], "r"))
+        result_df = parse_response(response)
+        result_df.to_csv(kwargs["output_filepath"])
 
     # cleanup
     mlflow.end_run()
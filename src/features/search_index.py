@@ -0,0 +1,252 @@
+import logging
+import sqlite3
+import time
+from typing import Iterable, List
+
+import click
+import mlflow
+import pandas as pd
+
+from src.features.parse_texts import COLUMN_NAMES, hash_row
+
+
+class SearchIndex:
+    """
+    転職理由の全文検索インデックス
+
+    SQLite FTS5 の trigram トークナイザを使うため、分かち書きなしで
+    日本語の部分一致検索ができる。trigram では引けない 2 文字以下の語
+    (給料、残業など) のため、各列を 2-gram に区切った文字列も別の FTS5
+    テーブルに索引する。同じ行は row_hash で重複を除くので、同じ CSV
+    を何度追加しても差分だけが登録される。
+    """
+
+    def __init__(self, index_filepath):
+        self.index_filepath = index_filepath
+        self.connection = sqlite3.connect(index_filepath)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+    def _create_tables(self):
+        has_bigram_table = (
+            self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'reasons_bigram'"
+            ).fetchone()
+            is not None
+        )
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS reasons (
+                id INTEGER PRIMARY KEY,
+                row_hash TEXT NOT NULL UNIQUE,
+                negative TEXT NOT NULL,
+                positive TEXT NOT NULL,
+                category TEXT NOT NULL,
+                source TEXT NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS reasons_fts USING fts5(
+                negative,
+                positive,
+                category,
+                content='reasons',
+                content_rowid='id',
+                tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS reasons_ai
+            AFTER INSERT ON reasons BEGIN
+                INSERT INTO reasons_fts(rowid, negative, positive, category)
+                VALUES (new.id, new.negative, new.positive, new.category);
+            END;
+            CREATE VIRTUAL TABLE IF NOT EXISTS reasons_bigram USING fts5(
+                negative,
+                positive,
+                category,
+                content='',
+                tokenize='ascii',
+                -- 漢字やかなの 1 文字 (UTF-8 で 3 バイト) の前方一致を速くする
+                prefix='6'
+            );
+            """
+        )
+        if not has_bigram_table:
+            # 2-gram の索引が無かった頃に作られたインデックスを埋める
+            with self.connection:
+                self._add_bigrams(0)
+
+    @staticmethod
+    def _encode_bigrams(text: str) -> List[str]:
+        # 記号や空白で語が切れないよう、2-gram を UTF-8 の 16 進表記にする
+        text = text.lower()
+        return [
+            text[i : i + 2].encode("utf-8").hex()
+            for i in range(len(text) - 1)
+        ]
+
+    def _to_bigrams(self, text: str) -> str:
+        # 1 文字の語も前方一致で引けるよう、末尾の 1 文字も加える
+        tokens = self._encode_bigrams(text) + [
+            text[-1:].lower().encode("utf-8").hex()
+        ]
+        return " ".join(tokens)
+
+    def _add_bigrams(self, after_id: int):
+        rows = self.connection.execute(
+            "SELECT id, negative, positive, category FROM reasons"
+            " WHERE id > ?",
+            [after_id],
+        )
+        self.connection.executemany(
+            "INSERT INTO reasons_bigram"
+            " (rowid, negative, positive, category) VALUES (?, ?, ?, ?)",
+            (
+                (row[0], *[self._to_bigrams(text) for text in row[1:]])
+                for row in rows
+            ),
+        )
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _max_id(self) -> int:
+        return self.connection.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM reasons"
+        ).fetchone()[0]
+
+    def add_dataframe(self, df: pd.DataFrame, source: str = "") -> int:
+        """parse_texts の出力形式の DataFrame を追加し、追加件数を返す"""
+        values = df[COLUMN_NAMES].fillna("").astype(str)
+        rows = [
+            (hash_row(cells), *cells, source)
+            for cells in values.itertuples(index=False, name=None)
+        ]
+        with self.connection:
+            before = self._max_id()
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO reasons"
+                " (row_hash, negative, positive, category, source)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            # INSERT OR IGNORE で弾かれた行は id を消費しない
+            inserted = self._max_id() - before
+            self._add_bigrams(before)
+        return inserted
+
+    def add_csv(self, csv_filepath: str, chunksize: int = 100000) -> int:
+        """parse_texts の出力 CSV をチャンク単位で追加する"""
+        inserted = 0
+        for chunk in pd.read_csv(
+            csv_filepath, usecols=COLUMN_NAMES, dtype=str, chunksize=chunksize
+        ):
+            inserted += self.add_dataframe(chunk, source=csv_filepath)
+        return inserted
+
+    @staticmethod
+    def _build_match_query(terms: List[str]) -> str:
+        # 各語をフレーズとしてエスケープし AND 検索にする
+        phrases = ['"{}"'.format(term.replace('"', '""')) for term in terms]
+        return " AND ".join(phrases)
+
+    def _build_bigram_query(self, terms: List[str]) -> str:
+        # 2 文字以上の語は連続する 2-gram のフレーズ、1 文字の語は前方一致
+        phrases = []
+        for term in terms:
+            tokens = self._encode_bigrams(term)
+            if len(tokens) == 0:
+                phrases.append('"{}" *'.format(term.lower().encode().hex()))
+            else:
+                phrases.append('"{}"'.format(" ".join(tokens)))
+        return " AND ".join(phrases)
+
+    def search(self, query: str, limit: int = 100) -> pd.DataFrame:
+        """
+        部分一致で検索し、新しく登録された順の DataFrame を返す
+
+        全ての語が 3 文字以上なら trigram の索引、2 文字以下の語を含む
+        なら 2-gram の索引で引く。どちらも rowid の降順に limit 件だけ
+        読むため、件数の多い語でも全件を走査しない。
+        """
+        terms = query.split()
+        if len(terms) == 0:
+            return pd.DataFrame(columns=COLUMN_NAMES)
+
+        if all(len(term) >= 3 for term in terms):
+            table = "reasons_fts"
+            match_query = self._build_match_query(terms)
+        else:
+            table = "reasons_bigram"
+            match_query = self._build_bigram_query(terms)
+        sql = (
+            "SELECT r.negative, r.positive, r.category"
+            f" FROM {table} JOIN reasons AS r ON r.id = {table}.rowid"
+            f" WHERE {table} MATCH ?"
+            f" ORDER BY {table}.rowid DESC LIMIT ?"
+        )
+        rows = self.connection.execute(sql, [match_query, limit]).fetchall()
+        return pd.DataFrame(
+            [tuple(row) for row in rows], columns=COLUMN_NAMES
+        )
+
+    def count(self) -> int:
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM reasons"
+        ).fetchone()[0]
+
+
+def build_index(index_filepath: str, input_filepaths: Iterable[str]) -> int:
+    """CSV 群から検索インデックスを差分更新する"""
+
+    # init log
+    logger = logging.getLogger(__name__)
+
+    inserted = 0
+    with SearchIndex(index_filepath) as index:
+        for input_filepath in input_filepaths:
+            n_rows = index.add_csv(input_filepath)
+            logger.info(f"inserted {n_rows} rows from {input_filepath}")
+            inserted += n_rows
+        total = index.count()
+    logger.info(f"inserted: {inserted}, total: {total}")
+    mlflow.log_metric("n_inserted", inserted)
+    mlflow.log_metric("n_total", total)
+    return inserted
+
+
+@click.command()
+@click.argument("index_filepath", type=click.Path())
+@click.argument("input_filepaths", type=click.Path(exists=True), nargs=-1)
+@click.option("--mlflow_run_name", type=str, default="develop")
+def main(**kwargs):
+    """メイン処理"""
+
+    # init log
+    logger = logging.getLogger(__name__)
+
+    # logging
+    logger.info("start process")
+    logger.info({f"args.{k}": v for k, v in kwargs.items()})
+    mlflow.set_experiment("search_index")
+    mlflow.start_run(run_name=kwargs["mlflow_run_name"])
+    mlflow.log_params({f"args.{k}": v for k, v in kwargs.items()})
+
+    start_time = time.time()
+    build_index(kwargs["index_filepath"], kwargs["input_filepaths"])
+    mlflow.log_metric("elapsed_time", time.time() - start_time)
+
+    # cleanup
+    mlflow.end_run()
+    logger.info("complete process")
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
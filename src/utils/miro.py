@@ -1,22 +1,41 @@
+import hashlib
+import html
+import re
 import time
 
 import requests
 
 
+def strip_rank(text):
+    """付箋の文言から順位と割合を取り除き、同一性の判定に使うキーにする"""
+    return re.sub(r"\(\d+\.\d\)$", "", re.sub(r"^\d+\. ", "", text))
+
+
 class MiroHandler:
     """
     miro handler
     """
 
-    def __init__(self, access_token, board_id, time_wait=1.0):
+    def __init__(
+        self,
+        access_token,
+        board_id,
+        time_wait=1.0,
+        base_url="https://api.miro.com",
+    ):
         self.access_token = access_token
         self.board_id = board_id
         self.time_wait = time_wait
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers.update(
+            {"Authorization": "Bearer {}".format(self.access_token)}
+        )
 
     def _create_miro_object(self, data, miro_object_type="widgets"):
         headers = {"Authorization": "Bearer {}".format(self.access_token)}
-        url_create_widget = "https://api.miro.com/v1/boards/{}/{}".format(
-            self.board_id, miro_object_type
+        url_create_widget = "{}/v1/boards/{}/{}".format(
+            self.base_url, self.board_id, miro_object_type
         )
         response = requests.post(url_create_widget, json=data, headers=headers)
         print(response.text)
@@ -35,3 +54,141 @@ class MiroHandler:
         data["style"] = data_style
         data["text"] = f"<p>{text}</p>"
         return data
+
+    def _request(self, method, path, **kwargs):
+        url = "{}/v2/boards/{}/{}".format(self.base_url, self.board_id, path)
+        response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        if method != "GET":
+            time.sleep(self.time_wait)
+        return response.json() if len(response.content) > 0 else {}
+
+    def _list_by_offset(self, path, params, limit=50):
+        # tags やタグ指定の items は offset と total でページ送りする
+        results = []
+        params = dict(params, limit=limit, offset=0)
+        while True:
+            page = self._request("GET", path, params=params)
+            data = page.get("data", [])
+            results.extend(data)
+            params["offset"] += len(data)
+            if len(data) == 0 or params["offset"] >= page.get("total", 0):
+                return results
+
+    def get_or_create_tag(self, title):
+        """タイトルが一致するタグを返し、無ければ作成する"""
+        for tag in self._list_by_offset("tags", {}):
+            if tag["title"] == title:
+                return tag["id"]
+        tag = self._request("POST", "tags", json={"title": title})
+        return tag["id"]
+
+    def list_stickies(self, tag_id=None, limit=50):
+        """ボード上の付箋 (tag_id 指定時はそのタグの付箋) を全て取得"""
+        if tag_id is not None:
+            # タグで絞り込むときは cursor ではなく offset でページ送りする
+            items = self._list_by_offset(
+                "items", {"tag_id": tag_id}, limit=limit
+            )
+            return [item for item in items if item["type"] == "sticky_note"]
+
+        stickies = []
+        params = {"type": "sticky_note", "limit": limit}
+        while True:
+            page = self._request("GET", "items", params=params)
+            stickies.extend(page.get("data", []))
+            cursor = page.get("cursor")
+            if not cursor:
+                return stickies
+            params["cursor"] = cursor
+
+    def create_sticky(self, text, tag_id=None):
+        # add_sticky と同じ見た目になるよう v1 の widgets で作成する
+        url = "{}/v1/boards/{}/widgets".format(self.base_url, self.board_id)
+        response = self.session.post(url, json=self.build_sticker_data(text))
+        response.raise_for_status()
+        time.sleep(self.time_wait)
+        widget = response.json()
+        if tag_id is not None:
+            self._request(
+                "POST", f"items/{widget['id']}", params={"tag_id": tag_id}
+            )
+        return widget
+
+    def update_sticky(self, item_id, text):
+        data = {"data": {"content": f"<p>{text}</p>"}}
+        return self._request("PATCH", f"sticky_notes/{item_id}", json=data)
+
+    def delete_sticky(self, item_id):
+        return self._request("DELETE", f"sticky_notes/{item_id}")
+
+    @staticmethod
+    def normalize_text(content):
+        """付箋の HTML から比較用のテキストを取り出す"""
+        text = re.sub("<[^>]+>", " ", content)
+        return " ".join(html.unescape(text).split())
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def sync_stickies(
+        self, texts, key_fn=None, tag="chat_memo", delete=False
+    ):
+        """
+        タグ tag の付いた付箋を texts に揃える
+
+        このツールが作成した付箋にはタグを付け、同期ではそのタグの付箋
+        だけを一度取得して key_fn(テキスト) で索引を作る。同じキーで
+        内容が同じものはそのまま、内容が違うものは更新、無いものは
+        タグ付きで作成する。texts に無い付箋と重複した付箋は delete が
+        真のときだけ削除し、手で貼られた付箋には触れない。
+        """
+        if key_fn is None:
+
+            def key_fn(text):
+                return text
+
+        tag_id = self.get_or_create_tag(tag)
+
+        # 既存の付箋をキーで索引
+        existing = {}
+        duplicates = []
+        for sticky in self.list_stickies(tag_id=tag_id):
+            text = self.normalize_text(sticky["data"].get("content", ""))
+            key = self.hash_text(key_fn(text))
+            if key in existing:
+                duplicates.append(sticky["id"])
+            else:
+                existing[key] = (sticky["id"], self.hash_text(text))
+
+        stats = {
+            "created": 0,
+            "updated": 0,
+            "unchanged": 0,
+            "deleted": 0,
+            "stale": 0,
+        }
+        for text in texts:
+            normalized = self.normalize_text(text)
+            key = self.hash_text(key_fn(normalized))
+            if key not in existing:
+                self.create_sticky(text, tag_id=tag_id)
+                stats["created"] += 1
+                continue
+            item_id, text_hash = existing.pop(key)
+            if text_hash == self.hash_text(normalized):
+                stats["unchanged"] += 1
+            else:
+                self.update_sticky(item_id, text)
+                stats["updated"] += 1
+
+        # 残った付箋は不要なもの
+        stale_ids = [item_id for item_id, _ in existing.values()]
+        if not delete:
+            stats["stale"] = len(stale_ids) + len(duplicates)
+            return stats
+        for item_id in stale_ids + duplicates:
+            self.delete_sticky(item_id)
+            stats["deleted"] += 1
+        return stats
@@ -0,0 +1,172 @@
+import cProfile
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+import mlflow
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+
+class StackSampler:
+    """
+    対象スレッドのスタックを一定間隔で採取するサンプラ
+
+    flamegraph.pl や speedscope でそのまま読める collapsed-stack 形式
+    (関数名を ; で連結したスタックとサンプル数) で書き出す。
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts: Counter = Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _format_frame(frame):
+        code = frame.f_code
+        name = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+        return name.replace(";", ":")
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._format_frame(frame))
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def dump(self, output_filepath):
+        with open(output_filepath, "w") as fo:
+            for stack, count in self.counts.most_common():
+                print(f"{stack} {count}", file=fo)
+
+
+def _start_profiler():
+    # サンプリングプロファイラがあれば優先し、無ければ cProfile を使う
+    if Profiler is not None:
+        profiler = Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler, output_dirpath, name):
+    if Profiler is not None and isinstance(profiler, Profiler):
+        profiler.stop()
+        profile_filepath = os.path.join(output_dirpath, f"{name}.html")
+        with open(profile_filepath, "w") as fo:
+            fo.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profile_filepath = os.path.join(output_dirpath, f"{name}.prof")
+        profiler.dump_stats(profile_filepath)
+    return profile_filepath
+
+
+PROFILE_MODES = ["cpu", "memory"]
+
+
+@contextmanager
+def _profile_cpu(name, output_dirpath):
+    # init log
+    logger = logging.getLogger(__name__)
+
+    sampler = StackSampler(threading.get_ident())
+    sampler.start()
+    try:
+        profiler = _start_profiler()
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed_time = time.time() - start_time
+            profile_filepath = _stop_profiler(profiler, output_dirpath, name)
+    finally:
+        sampler.stop()
+
+    collapsed_filepath = os.path.join(output_dirpath, f"{name}.collapsed")
+    sampler.dump(collapsed_filepath)
+    # ru_maxrss は Linux では KB 単位のプロセス全体のピーク
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # logging
+    logger.info(f"profile: {profile_filepath}, {collapsed_filepath}")
+    mlflow.log_metric("profile.cpu.elapsed_time", elapsed_time)
+    mlflow.log_metric("profile.cpu.max_rss_mb", max_rss_mb)
+    mlflow.log_artifact(profile_filepath, artifact_path="profile")
+    mlflow.log_artifact(collapsed_filepath, artifact_path="profile")
+
+
+@contextmanager
+def _profile_memory(name, output_dirpath, n_top_stats=50):
+    # init log
+    logger = logging.getLogger(__name__)
+
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        try:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+    # 確保したメモリの多い行を書き出す
+    stats_filepath = os.path.join(output_dirpath, f"{name}.tracemalloc.txt")
+    with open(stats_filepath, "w") as fo:
+        for stat in snapshot.statistics("lineno")[:n_top_stats]:
+            print(stat, file=fo)
+
+    # logging
+    logger.info(f"profile: {stats_filepath}")
+    mlflow.log_metric("profile.memory.peak_mb", peak / 1024**2)
+    mlflow.log_artifact(stats_filepath, artifact_path="profile")
+
+
+@contextmanager
+def profile_run(mode, name, output_dirpath="data/interim/profile"):
+    """
+    ブロック内の処理をプロファイルし、結果を実行中の mlflow run に記録
+
+    mode が "cpu" なら cProfile (pyinstrument があればそちら) の結果と
+    collapsed-stack ファイル、"memory" なら tracemalloc のピークと
+    確保量の多い行を保存する。tracemalloc は割り当ての多い処理を数倍
+    遅くして CPU の計測を歪めるため、両者は同じ実行では測らない。
+    mode が None なら何もしない。
+    """
+    if mode is None:
+        yield
+        return
+
+    os.makedirs(output_dirpath, exist_ok=True)
+    if mode == "cpu":
+        profiler = _profile_cpu(name, output_dirpath)
+    elif mode == "memory":
+        profiler = _profile_memory(name, output_dirpath)
+    else:
+        raise ValueError(f"unknown profile mode: {mode}")
+    with profiler:
+        yield
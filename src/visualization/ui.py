@@ -11,7 +11,11 @@ import openai
 import pandas as pd
 import yaml
 
-from src.utils.miro import MiroHandler
+from src.features.search_index import SearchIndex
+from src.utils.miro import MiroHandler, strip_rank
+from src.utils.profiling import PROFILE_MODES, profile_run
+
+SEARCH_INDEX_FILEPATH = "data/interim/search_index.db"
 
 
 def load_credential(credential_path: str) -> Dict:
@@ -29,6 +33,11 @@ def greet(text):
     return "Hello " + text + "!"
 
 
+def search_texts(query):
+    with SearchIndex(SEARCH_INDEX_FILEPATH) as index:
+        return index.search(query)
+
+
 def define_functions():
     functions = [
         {
@@ -157,26 +166,50 @@ def generate_texts(openai_api_key, kwargs):
     return prompt, result_df
 
 
-def stick_to_miro(prompt, result_df, access_token, board_id):
+def stick_to_miro(
+    prompt,
+    result_df,
+    access_token,
+    board_id,
+    sync=False,
+    sync_tag="chat_memo",
+    sync_delete=False,
+):
     # init log
     logger = logging.getLogger(__name__)
 
     # init miro handler
     miro = MiroHandler(access_token=access_token, board_id=board_id)
 
-    # add sticky of prompt
-    miro.add_sticky(prompt)
-
-    # add sticky of each text
+    # build messages of each text
     sorted_df = (
         result_df.groupby("text").count()[["index"]].sort_index().reset_index()
     )
     sorted_df["ratio"] = 100.0 * sorted_df["index"] / len(sorted_df)
+    messages = []
     for index, row in sorted_df.iterrows():
         message = f"{index:03d}. {row['text']}({row['ratio']:0.1f})"
-        miro.add_sticky(message)
+        messages.append(message)
         logger.info(message)
 
+    if sync:
+        # 既存の付箋との差分だけを反映
+        stats = miro.sync_stickies(
+            [prompt] + messages,
+            key_fn=strip_rank,
+            tag=sync_tag,
+            delete=sync_delete,
+        )
+        logger.info(f"sync: {stats}")
+        mlflow.log_metrics({f"miro.{k}": v for k, v in stats.items()})
+    else:
+        # add sticky of prompt
+        miro.add_sticky(prompt)
+
+        # add sticky of each text
+        for message in messages:
+            miro.add_sticky(message)
+
     sorted_output_filepath = "data/interim/miro_output.csv"
     sorted_df.to_csv(sorted_output_filepath)
     mlflow.log_artifact(sorted_output_filepath)
@@ -186,6 +219,10 @@ def stick_to_miro(prompt, result_df, access_token, board_id):
 @click.argument("board_id", type=str)
 @click.argument("output_filepath", type=click.Path())
 @click.option("--param_n", type=int, default=10)
+@click.option("--sync", is_flag=True, default=False)
+@click.option("--sync_tag", type=str, default="chat_memo")
+@click.option("--sync_delete", is_flag=True, default=False)
+@click.option("--profile", type=click.Choice(PROFILE_MODES), default=None)
 @click.option("--mlflow_run_name", type=str, default="develop")
 def main(**kwargs):
     # init log
@@ -196,22 +233,28 @@ def main(**kwargs):
     mlflow.start_run(run_name=kwargs["mlflow_run_name"])
     mlflow.log_params({f"args.{k}": v for k, v in kwargs.items()})
 
-    # load credentials
-    credential = load_credential("config/credential.yaml")
-
-    # generate texts
-    prompt, result_df = generate_texts(credential["openai"]["api_key"], kwargs)
-
-    # output to csv
-    result_df.to_csv(kwargs["output_filepath"])
-
-    # output to miro
-    stick_to_miro(
-        prompt,
-        result_df,
-        access_token=credential["miro"]["access_token"],
-        board_id=kwargs["board_id"],
-    )
+    with profile_run(kwargs["profile"], "ui"):
+        # load credentials
+        credential = load_credential("config/credential.yaml")
+
+        # generate texts
+        prompt, result_df = generate_texts(
+            credential["openai"]["api_key"], kwargs
+        )
+
+        # output to csv
+        result_df.to_csv(kwargs["output_filepath"])
+
+        # output to miro
+        stick_to_miro(
+            prompt,
+            result_df,
+            access_token=credential["miro"]["access_token"],
+            board_id=kwargs["board_id"],
+            sync=kwargs["sync"],
+            sync_tag=kwargs["sync_tag"],
+            sync_delete=kwargs["sync_delete"],
+        )
 
     # cleanup
     mlflow.end_run()
@@ -223,5 +266,11 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format=log_fmt)
     main()
 else:
-    ui = gr.Interface(fn=greet, inputs="text", outputs="text")
+    greet_ui = gr.Interface(fn=greet, inputs="text", outputs="text")
+    search_ui = gr.Interface(
+        fn=search_texts, inputs="text", outputs="dataframe"
+    )
+    ui = gr.TabbedInterface(
+        [greet_ui, search_ui], ["miro に付箋を貼る", "検索"]
+    )
     ui.launch(server_port=3000)
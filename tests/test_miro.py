@@ -0,0 +1,233 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from src.utils.miro import MiroHandler, strip_rank
+
+
+class FakeMiroBoard:
+    """miro の REST API のうち MiroHandler が使う部分だけを再現する"""
+
+    def __init__(self):
+        self.items = {}
+        self.tags = {}
+        self.item_tags = {}
+        self.calls = []
+        self.next_id = 0
+
+    def new_id(self):
+        self.next_id += 1
+        return str(self.next_id)
+
+    def add_sticky(self, content, tag_ids=()):
+        item_id = self.new_id()
+        self.items[item_id] = {
+            "id": item_id,
+            "type": "sticky_note",
+            "data": {"content": content},
+            "style": {"fontSize": 40},
+        }
+        self.item_tags[item_id] = set(tag_ids)
+        return self.items[item_id]
+
+    def contents(self):
+        return sorted(item["data"]["content"] for item in self.items.values())
+
+
+class FakeMiroRequestHandler(BaseHTTPRequestHandler):
+    board: FakeMiroBoard
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_empty(self):
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length > 0 else {}
+
+    def _route(self, method):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = re.sub(r"^/v\d/boards/[^/]+/", "", url.path)
+        version = url.path.split("/")[1]
+        self.board.calls.append((method, version, path))
+        return version, path, query
+
+    @staticmethod
+    def _page_by_offset(data, query):
+        offset = int(query.get("offset", 0))
+        limit = int(query["limit"])
+        return {
+            "data": data[offset : offset + limit],
+            "offset": offset,
+            "limit": limit,
+            "total": len(data),
+        }
+
+    def do_GET(self):
+        _, path, query = self._route("GET")
+        if path == "tags":
+            tags = list(self.board.tags.values())
+            self._send(self._page_by_offset(tags, query))
+        elif path == "items" and "tag_id" in query:
+            items = [
+                item
+                for item_id, item in sorted(self.board.items.items())
+                if query["tag_id"] in self.board.item_tags[item_id]
+            ]
+            self._send(self._page_by_offset(items, query))
+        elif path == "items":
+            items = [item for _, item in sorted(self.board.items.items())]
+            start = int(query.get("cursor", 0))
+            limit = int(query["limit"])
+            page = {"data": items[start : start + limit]}
+            if start + limit < len(items):
+                page["cursor"] = str(start + limit)
+            self._send(page)
+        else:
+            self._send({}, status=404)
+
+    def do_POST(self):
+        version, path, query = self._route("POST")
+        if version == "v1" and path == "widgets":
+            data = self._read_json()
+            item = self.board.add_sticky(data["text"])
+            item["style"] = data["style"]
+            self._send(item, status=201)
+        elif path == "tags":
+            tag_id = self.board.new_id()
+            tag = {"id": tag_id, "type": "tag", **self._read_json()}
+            self.board.tags[tag_id] = tag
+            self._send(tag, status=201)
+        elif path.startswith("items/"):
+            item_id = path.split("/")[1]
+            self.board.item_tags[item_id].add(query["tag_id"])
+            self._send_empty()
+        else:
+            self._send({}, status=404)
+
+    def do_PATCH(self):
+        _, path, _ = self._route("PATCH")
+        item_id = path.split("/")[1]
+        self.board.items[item_id]["data"].update(self._read_json()["data"])
+        self._send(self.board.items[item_id])
+
+    def do_DELETE(self):
+        _, path, _ = self._route("DELETE")
+        item_id = path.split("/")[1]
+        del self.board.items[item_id]
+        del self.board.item_tags[item_id]
+        self._send_empty()
+
+
+@pytest.fixture
+def board():
+    board = FakeMiroBoard()
+    handler = type("Handler", (FakeMiroRequestHandler,), {"board": board})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    board.base_url = f"http://127.0.0.1:{server.server_port}"
+    yield board
+    server.shutdown()
+
+
+def make_handler(board):
+    return MiroHandler(
+        access_token="token",
+        board_id="board",
+        time_wait=0.0,
+        base_url=board.base_url,
+    )
+
+
+def make_texts(n, ratio):
+    return ["prompt"] + [
+        f"{i:03d}. reason{i}({ratio:0.1f})" for i in range(n)
+    ]
+
+
+def count_calls(board, method):
+    return len([call for call in board.calls if call[0] == method])
+
+
+def test_sync_creates_then_skips_unchanged(board):
+    miro = make_handler(board)
+    texts = make_texts(120, 1.0)
+
+    stats = miro.sync_stickies(texts, key_fn=strip_rank)
+    assert stats["created"] == 121
+    assert all(
+        item["style"] == {"fontSize": 40} for item in board.items.values()
+    )
+
+    board.calls.clear()
+    stats = miro.sync_stickies(texts, key_fn=strip_rank)
+    assert stats["unchanged"] == 121
+    # タグ一覧 1 回と、付箋 121 件を 50 件ずつ 3 ページ取得するだけ
+    assert board.calls == [("GET", "v2", "tags")] + [
+        ("GET", "v2", "items")
+    ] * 3
+
+
+def test_sync_updates_and_keeps_stale_without_delete(board):
+    miro = make_handler(board)
+    miro.sync_stickies(make_texts(10, 1.0), key_fn=strip_rank)
+
+    board.calls.clear()
+    texts = make_texts(8, 2.0) + ["new reason"]
+    stats = miro.sync_stickies(texts, key_fn=strip_rank)
+    assert stats == {
+        "created": 1,
+        "updated": 8,
+        "unchanged": 1,
+        "deleted": 0,
+        "stale": 2,
+    }
+    assert count_calls(board, "PATCH") == 8
+    assert count_calls(board, "DELETE") == 0
+    assert len(board.items) == 12
+
+
+def test_sync_deletes_only_own_stickies(board):
+    manual = board.add_sticky("<p>000. reason0(9.9)</p>")
+    miro = make_handler(board)
+    miro.sync_stickies(make_texts(5, 1.0), key_fn=strip_rank)
+
+    stats = miro.sync_stickies(
+        make_texts(3, 1.0), key_fn=strip_rank, delete=True
+    )
+    assert stats["deleted"] == 2
+    assert manual["id"] in board.items
+    assert board.contents() == sorted(
+        [manual["data"]["content"]]
+        + [f"<p>{text}</p>" for text in make_texts(3, 1.0)]
+    )
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("001. reason(12.5)", "reason"),
+        ("1000. reason(0.3)", "reason"),
+        ("reason", "reason"),
+    ],
+)
+def test_strip_rank(text, expected):
+    assert strip_rank(text) == expected